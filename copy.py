@@ -1,91 +1,571 @@
+import array
+import ctypes
+import errno
+import io
+import mmap
 import os
 import shutil
+import stat
+import struct
+import sys
 import threading
 import queue
 import psutil
 import tkinter as tk
 from tkinter import ttk, messagebox, filedialog
 import time
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
 
 # -------- Configuration --------
-ESTIMATED_AVG_FILE_SIZE = 500 * 1024 * 1024  # 500 MB average for better thread count estimation
+BUFFER_SIZE = 4 * 1024 * 1024  # 4 MB buffer for faster large file transfer, when the destination can't be probed
+MIN_BUFFER_SIZE = 1024 * 1024  # Smallest buffer picked from the destination's block size...
+BUFFER_BLOCKS = 16  # ...which is this many filesystem blocks
+MAX_THREADS = 32  # Copy threads spend their time blocked in I/O syscalls, so allow more than the core count
+ROTATIONAL_THREADS = 1  # Workers reading from a spinning disk, where each extra one adds seeks between files
+PREFETCH_SIZE = 64 * 1024 * 1024  # How far ahead to ask the kernel to start reading each source file
+F_RDADVISE = 44  # macOS fcntl command taking a struct radvisory; not exposed by the fcntl module
+KERNEL_COPY_CHUNK = 16 * 1024 * 1024  # Bytes per copy_file_range()/sendfile() call, between progress updates
+HAVE_COPY_FILE_RANGE = sys.platform.startswith('linux') and hasattr(os, 'copy_file_range')
+# copy_file_range() refuses some file pairs (older kernels across filesystems, FUSE, ...)
+KERNEL_COPY_FALLBACK_ERRNOS = {errno.EXDEV, errno.EINVAL, errno.ENOSYS, errno.EOPNOTSUPP, errno.EBADF}
+# sendfile() copies file to file on Linux 2.6.33+, covering pairs copy_file_range() refuses
+HAVE_SENDFILE = sys.platform.startswith('linux') and hasattr(os, 'sendfile')
+FALLOC_FL_KEEP_SIZE = 1  # fallocate() mode reserving blocks without changing the file size
+FICLONE = 0x40049409  # Linux ioctl sharing all extents of one file with another (btrfs, XFS, bcachefs)
+# Answers meaning no clone will work for this source/destination pair, so stop asking
+CLONE_UNSUPPORTED_ERRNOS = {errno.EOPNOTSUPP, errno.ENOTTY, errno.EINVAL, errno.EXDEV}
+O_BINARY = getattr(os, 'O_BINARY', 0)  # Windows only; keeps os.open() from translating newlines
+MMAP_THRESHOLD = 64 * 1024 * 1024  # Without a kernel copy, files above this are written straight from a mapping
+SMALL_FILE_THRESHOLD = 64 * 1024  # Files below this are copied with a single read/write, in batches
+SMALL_FILE_BATCH = 256  # Small files handed to a worker per queue item
+FIRST_READ_SIZE = 64 * 1024  # User-space copies start with reads this big and double them up to buffer_size
+QUEUE_WAIT_TIMEOUT = 0.25  # Idle workers wake this often to notice a cancel
+STATUS_ROWS = 10  # Worker lines the status panel has room for; the rest are summed up in one more line
+REDRAW_STEPS = 100  # Progress labels are redrawn each time this fraction of the files is done...
+REDRAW_BYTES = 16 * 1024 * 1024  # ...or this many more bytes, not on every tick
 
 # -------- Globals --------
-file_queue = queue.Queue()
-progress_queue = queue.Queue()
+_libc = ctypes.CDLL(None, use_errno=True) if os.name == 'posix' else None
+_clonefile = getattr(_libc, 'clonefile', None) if sys.platform == 'darwin' else None
+# fallocate(2) directly rather than os.posix_fallocate(): glibc emulates the latter by writing a
+# byte per block on filesystems without support, which would be far slower than not preallocating
+_fallocate = getattr(_libc, 'fallocate64', None) if sys.platform.startswith('linux') else None
+if _fallocate is not None:
+    _fallocate.argtypes = [ctypes.c_int, ctypes.c_int, ctypes.c_int64, ctypes.c_int64]
+# CPUs the process may use, read once on the main thread before any worker narrows its own mask
+_process_cpus = sorted(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else None
+file_queue = queue.Queue()  # Lists of (src, dest, stat_result); small files are grouped, large files go alone. None ends a worker
 total_files = 0
-copied_files = 0
+copied_files = 0  # Sums of the per-worker counters below, taken by the UI thread
 total_bytes_copied = 0
 pause_event = threading.Event()
 cancel_event = threading.Event()
+scan_done = threading.Event()  # Set once the walk has queued every file; total_files is final from then on
 start_time = None
-
-# Track thread-specific status messages
-thread_status = {}
-thread_status_lock = threading.Lock()
+buffer_size = BUFFER_SIZE  # Probed from the destination filesystem in start_copy
+preserve_metadata = False  # Copies of the checkboxes, read by the walk and the metadata pass
+preserve_xattrs = False
+metadata_pending = []  # Per-directory file lists from the walk, kept only when preserving metadata
+sendfile_usable = HAVE_SENDFILE  # Cleared for good the first time the kernel rejects a file destination
+clone_usable = False  # Same device on both sides; cleared for the run once the filesystem refuses a clone
+
+# Status panel, one slot per worker index. start_copy sizes these on the Tk thread, which is
+# also the only reader, and each worker only writes its own slot. Workers store plain numbers
+# while copying and update_ui builds the text, so no lock and no per-chunk string formatting
+worker_label = []  # File name or status text
+worker_copied = array.array('q')  # Bytes of the current file copied so far...
+worker_total = array.array('q')  # ...out of this many; -1 shows the label alone
+worker_files = array.array('q')  # Files finished by each worker
+worker_bytes = array.array('q')  # Bytes in those files
+worker_failed = []  # Destinations each worker failed to copy, left alone by the metadata pass
+
+# What update_ui last put on screen; Tk lays a label out again on every set(), so ticks
+# that would draw the same figures skip it
+_last_drawn_files = 0
+_last_drawn_bytes = 0
+_last_drawn_second = -1
+_last_status_text = None
 
 # -------- Helpers --------
 def get_available_memory():
     return psutil.virtual_memory().available
 
 def estimate_thread_count():
+    # Workers hold two fixed-size buffers each, so memory only caps the count on very small machines
     available_mem = get_available_memory()
-    return max(1, min(8, available_mem // ESTIMATED_AVG_FILE_SIZE))  # Limit to 8 threads for large files
+    io_threads = min(MAX_THREADS, (os.cpu_count() or 1) + 4)
+    return max(1, min(io_threads, available_mem // (4 * buffer_size)))
 
-def populate_file_queue(source_dir):
-    global total_files
-    for root_dir, dirs, files in os.walk(source_dir):
-        for file in files:
-            full_path = os.path.join(root_dir, file)
-            file_queue.put(full_path)
-    total_files = file_queue.qsize()
+def pin_to_cpu(index):
+    # Keep each worker (and its buffers) on one core instead of being migrated between caches.
+    # Only Linux can pin a single thread; psutil's cpu_affinity() would pin the whole process.
+    if not _process_cpus:
+        return
+    try:
+        os.sched_setaffinity(0, {_process_cpus[index % len(_process_cpus)]})
+    except OSError:
+        pass
 
-# -------- Copy Worker --------
-def copy_worker(source_dir, dest_dir):
-    global copied_files, total_bytes_copied
-    buffer_size = 4 * 1024 * 1024  # 4 MB buffer for faster large file transfer
-    thread_name = threading.current_thread().name
+def unpin_from_cpu():
+    # Threads inherit their creator's mask; a helper doing its own I/O shouldn't share its core
+    if not _process_cpus:
+        return
+    try:
+        os.sched_setaffinity(0, _process_cpus)
+    except OSError:
+        pass
+
+def probe_buffer_size(dest_dir):
+    # Whole multiples of the destination's preferred I/O size (1 MB on NFS, 4 KB or more elsewhere)
+    # keep every write aligned and cut the number of transactions per file
+    if not hasattr(os, 'statvfs'):
+        return BUFFER_SIZE
+    try:
+        block = os.statvfs(dest_dir).f_bsize
+    except OSError:
+        return BUFFER_SIZE
+    if block <= 0:
+        return BUFFER_SIZE
+    size = max(MIN_BUFFER_SIZE, BUFFER_BLOCKS * block)
+    return -(-size // block) * block
+
+def is_rotational(path):
+    # Linux reports this per block device; a partition has no queue of its own, so fall back to
+    # its parent disk. Anything unknown (other systems, network and virtual filesystems) counts as not
+    if not sys.platform.startswith('linux'):
+        return False
+    try:
+        dev = os.stat(path).st_dev
+    except OSError:
+        return False
+    block = os.path.realpath(f"/sys/dev/block/{os.major(dev)}:{os.minor(dev)}")
+    if '/virtio' in block or '/vbd-' in block:
+        return False  # VM disks (virtio, Xen) claim to rotate unless the host says otherwise
+    for device_dir in (block, os.path.dirname(block)):
+        try:
+            with open(os.path.join(device_dir, 'queue', 'rotational')) as f:
+                return f.read().strip() == '1'
+        except OSError:
+            continue
+    return False
+
+def scan_files(directory, dest_directory):
+    # DirEntry carries the file type from the listing (and the stat info on Windows), so each
+    # file is stat()ed at most once, here, and workers reuse the result instead of asking again.
+    # Destination paths are built alongside so workers never run relpath() per file.
+    # Yields (dest_directory, files) once per directory, before descending into its subdirectories.
+    try:
+        entries = list(os.scandir(directory))
+    except OSError:
+        return  # Unreadable directory, skip like os.walk does
+    files = []
+    subdirs = []
+    for entry in entries:
+        dest_path = os.path.join(dest_directory, entry.name)
+        try:
+            if entry.is_dir(follow_symlinks=False):
+                subdirs.append((entry.path, dest_path))
+            elif entry.is_file():
+                files.append((entry.path, dest_path, entry.stat()))
+        except OSError:
+            continue
+    yield dest_directory, files
+    for path, dest_path in subdirs:
+        yield from scan_files(path, dest_path)
+
+def populate_file_queue(source_dir, dest_dir, num_workers):
+    # Runs on its own thread while the workers copy what it has found so far. It is the only
+    # writer of total_files; the UI just reads the latest value.
+    global total_files
+    for dest_directory, files in scan_files(source_dir, dest_dir):
+        if cancel_event.is_set():
+            return
+        # Parents come before their children, so one mkdir() per directory, made before any of
+        # its files are queued, replaces a makedirs() per file in the workers
+        try:
+            os.mkdir(dest_directory)
+        except OSError:
+            pass  # Already there, or not creatable; its files then fail and finalize_ui counts them
+        total_files += len(files)
+        if preserve_metadata:
+            metadata_pending.append(files)
+        # Small-file batches never span directories, so each worker creates its files in one
+        # directory instead of several workers contending for the same directory's lock
+        small_files = []
+        for item in files:
+            if item[2].st_size < SMALL_FILE_THRESHOLD:
+                small_files.append(item)
+                if len(small_files) >= SMALL_FILE_BATCH:
+                    file_queue.put(small_files)
+                    small_files = []
+            else:
+                file_queue.put([item])
+        if small_files:
+            file_queue.put(small_files)
+    for _ in range(num_workers):
+        file_queue.put(None)  # One end-of-work marker per worker, queued after all the files
+    scan_done.set()
+
+def advise_sequential(fd, size):
+    # Hint that the file will be read front to back so the kernel widens its readahead window
+    try:
+        if hasattr(os, 'posix_fadvise'):
+            os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_SEQUENTIAL)
+            os.posix_fadvise(fd, 0, min(size, PREFETCH_SIZE), os.POSIX_FADV_WILLNEED)
+        elif fcntl and sys.platform == 'darwin':
+            # Large macOS files that clonefile() can't take come through the FileIO path too
+            fcntl.fcntl(fd, F_RDADVISE, struct.pack('qi', 0, min(size, PREFETCH_SIZE)))
+    except OSError:
+        pass  # Only a hint
+
+def advise_done(fd):
+    # Drop pages of a finished file so large copies don't evict the rest of the page cache
+    if hasattr(os, 'posix_fadvise'):
+        try:
+            os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+        except OSError:
+            pass
+
+def preallocate(fd, size):
+    # Reserve the whole file up front so the filesystem can hand out contiguous extents in one go.
+    # KEEP_SIZE leaves the length alone, so a cancelled or short copy isn't padded with zeros.
+    if _fallocate is not None:
+        _fallocate(fd, FALLOC_FL_KEEP_SIZE, 0, size)  # Failure (no fs support) is fine to ignore
+
+def write_all(dst, data):
+    # Raw FileIO writes may be short; keep going until the whole chunk is out
+    written = dst.write(data)
+    if written < len(data):
+        data = data[written:]
+        while data:
+            data = data[dst.write(data):]
+
+def copy_small_file(src_file, dest_file):
+    # Plain fds and one read/write pair: for tiny files the hints, fstat()s and progress
+    # updates of the large-file path cost more syscalls than the data itself
+    src_fd = os.open(src_file, os.O_RDONLY | O_BINARY)
+    try:
+        dst_fd = os.open(dest_file, os.O_WRONLY | os.O_CREAT | os.O_TRUNC | O_BINARY, 0o666)
+        try:
+            copied_size = 0
+            while True:
+                data = os.read(src_fd, SMALL_FILE_THRESHOLD)
+                n = len(data)
+                copied_size += n
+                while data:
+                    data = data[os.write(dst_fd, data):]
+                if n < SMALL_FILE_THRESHOLD:
+                    return copied_size  # A short read of a regular file is end of file, no need to read again
+        finally:
+            os.close(dst_fd)
+    finally:
+        os.close(src_fd)
 
+def try_reflink(src_fd, dst_fd):
+    # Copy-on-write clone: O(1) whatever the size, when both files live on one CoW filesystem
+    global clone_usable
+    if not clone_usable or not fcntl or not sys.platform.startswith('linux'):
+        return False
+    try:
+        fcntl.ioctl(dst_fd, FICLONE, src_fd)
+        return True
+    except OSError as e:
+        if e.errno in CLONE_UNSUPPORTED_ERRNOS:
+            clone_usable = False  # e.g. ext4: every further attempt would fail the same way
+        return False
+
+def try_clonefile(src_file, dest_file):
+    # APFS equivalent of try_reflink; clonefile() creates the destination itself
+    global clone_usable
+    if _clonefile is None or not clone_usable:
+        return False
+    src, dst = os.fsencode(src_file), os.fsencode(dest_file)
+    if _clonefile(src, dst, 0) == 0:
+        return True
+    err = ctypes.get_errno()
+    if err in CLONE_UNSUPPORTED_ERRNOS or err == errno.ENOTSUP:
+        clone_usable = False  # HFS+, exFAT, another volume, ...
+    if err != errno.EEXIST:
+        return False
+    try:
+        os.unlink(dest_file)  # It would be overwritten anyway
+    except OSError:
+        return False
+    return _clonefile(src, dst, 0) == 0
+
+def try_clone_tree(source_dir, dest_dir):
+    # An empty destination on the same APFS volume can take the whole tree as a single clone
+    if _clonefile is None:
+        return False
+    try:
+        dest_stat = os.stat(dest_dir)
+        if os.stat(source_dir).st_dev != dest_stat.st_dev or os.listdir(dest_dir):
+            return False
+        os.rmdir(dest_dir)  # clonefile() creates the destination itself
+    except OSError:
+        return False
+    if _clonefile(os.fsencode(source_dir), os.fsencode(dest_dir), 0) == 0:
+        return True
+    try:
+        os.mkdir(dest_dir)
+    except FileExistsError:
+        return False  # The failed clone left part of the tree behind; the copy fills in the rest
+    os.chmod(dest_dir, dest_stat.st_mode & 0o7777)
+    return False
+
+def set_status(index, label, total_size=-1):
+    worker_copied[index] = 0
+    worker_total[index] = total_size
+    worker_label[index] = label
+
+def set_progress(index, copied_size):
+    worker_copied[index] = copied_size
+
+def kernel_copy(src, dst, index):
+    # copy_file_range() moves the data inside the kernel (or reflinks it on CoW filesystems).
+    # Returns None when it can't be used for this pair so the caller can stream instead.
+    copied_size = 0
     while not cancel_event.is_set():
         pause_event.wait()
-
         try:
-            src_file = file_queue.get_nowait()
-        except queue.Empty:
+            n = os.copy_file_range(src.fileno(), dst.fileno(), KERNEL_COPY_CHUNK)
+        except OSError as e:
+            if copied_size == 0 and e.errno in KERNEL_COPY_FALLBACK_ERRNOS:
+                return None
+            raise
+        if not n:
+            if copied_size == 0:
+                return None  # Empty, or a pseudo-file reporting size 0; let a plain read decide
+            break
+        copied_size += n
+        set_progress(index, copied_size)
+    return copied_size
+
+def sendfile_copy(src, dst, index):
+    # In-kernel page cache to page cache copy; None when sendfile() can't write to files here
+    global sendfile_usable
+    copied_size = 0
+    while not cancel_event.is_set():
+        pause_event.wait()
+        try:
+            n = os.sendfile(dst.fileno(), src.fileno(), copied_size, KERNEL_COPY_CHUNK)
+        except OSError as e:
+            if copied_size == 0 and e.errno in (errno.EINVAL, errno.ENOSYS):
+                sendfile_usable = False
+                return None
+            raise
+        if not n:
+            if copied_size == 0:
+                return None  # Same pseudo-file caveat as kernel_copy()
             break
+        copied_size += n
+        set_progress(index, copied_size)
+    return copied_size
+
+def ensure_buffers(buffers):
+    # Allocated on first use: workers that only ever do kernel copies never map any. Anonymous
+    # pages are committed only once touched, so ramped reads keep small files from paying for
+    # the whole buffer either.
+    if not buffers:
+        for _ in range(2):
+            buf = mmap.mmap(-1, buffer_size)
+            buffers.append(memoryview(buf))
+    return buffers
+
+def next_read_size(size, full):
+    # Double after every full read, RocksDB-readahead style, so a short file never touches the
+    # whole buffer while a long one quickly reaches full-size reads
+    return size * 2 if size * 2 < full else full
+
+def stream_copy(src, dst, view, index):
+    # Hot loop: bound methods are looked up once, and full chunks are written from the
+    # read window itself so only a short read creates a slice
+    readinto = src.readinto
+    is_cancelled = cancel_event.is_set
+    wait_if_paused = pause_event.wait
+    full = len(view)
+    size = min(FIRST_READ_SIZE, full)
+    window = view[:size]
+    copied_size = 0
+    while not is_cancelled():
+        wait_if_paused()
+        n = readinto(window)
+        if not n:
+            break
+        write_all(dst, window if n == size else window[:n])
+        copied_size += n
+        set_progress(index, copied_size)
+        if n == size and size < full:
+            size = next_read_size(size, full)
+            window = view[:size]
+    return copied_size
+
+def pipelined_copy(src, dst, buffers, index):
+    # A helper thread reads the next chunk into one buffer while this thread writes the other,
+    # so the source and destination devices are busy at the same time
+    free = queue.SimpleQueue()
+    filled = queue.SimpleQueue()
+    for buffer in buffers:
+        free.put(buffer)
+
+    def reader():
+        unpin_from_cpu()  # Its readinto() copies run alongside the writer's, so not on the same core
+        full = len(buffers[0])
+        size = min(FIRST_READ_SIZE, full)
+        try:
+            while not cancel_event.is_set():
+                pause_event.wait()
+                buffer = free.get()
+                if buffer is None:
+                    return  # Writer gave up
+                n = src.readinto(buffer[:size])
+                filled.put((buffer, n))
+                if not n:
+                    return
+                if n == size:
+                    size = next_read_size(size, full)
+            filled.put((None, 0))
+        except Exception as e:
+            filled.put((None, e))
+
+    reader_thread = threading.Thread(target=reader, daemon=True, name=f"Worker-{index+1}-reader")
+    reader_thread.start()
+    copied_size = 0
+    try:
+        while True:
+            buffer, n = filled.get()
+            if isinstance(n, Exception):
+                raise n
+            if not n:
+                break
+            write_all(dst, buffer if n == len(buffer) else buffer[:n])
+            copied_size += n
+            set_progress(index, copied_size)
+            free.put(buffer)
+    finally:
+        free.put(None)
+        reader_thread.join()
+    return copied_size
+
+def mmap_copy(src, dst, index):
+    # Writing out of the source mapping skips copying every chunk into a user-space buffer first
+    copied_size = 0
+    with mmap.mmap(src.fileno(), 0, access=mmap.ACCESS_READ) as mm, memoryview(mm) as view:
+        size = len(mm)
+        while copied_size < size and not cancel_event.is_set():
+            pause_event.wait()
+            end = min(copied_size + buffer_size, size)
+            write_all(dst, view[copied_size:end])
+            copied_size = end
+            set_progress(index, copied_size)
+    return copied_size
 
-        rel_path = os.path.relpath(src_file, source_dir)
-        dest_file = os.path.join(dest_dir, rel_path)
-        os.makedirs(os.path.dirname(dest_file), exist_ok=True)
+# -------- Copy Worker --------
+def copy_metadata(src_file, dest_file, st):
+    if preserve_xattrs:
+        shutil.copystat(src_file, dest_file)
+        return
+    # Timestamps and permission bits straight from the walk's stat result: no xattr
+    # listing and no re-stat of the source, which dominate for tiny files
+    os.utime(dest_file, ns=(st.st_atime_ns, st.st_mtime_ns))
+    os.chmod(dest_file, stat.S_IMODE(st.st_mode))
+
+def apply_metadata():
+    # Runs once every worker has finished, so no later write can bump the times again. Going
+    # through the walk's lists keeps one directory's files together and reuses its stat results.
+    # A partial file must not get the source's times, or mtime-trusting sync tools would keep it.
+    failed = set().union(*worker_failed)
+    for files in metadata_pending:
+        if cancel_event.is_set():
+            break
+        for src_file, dest_file, st in files:
+            if dest_file in failed:
+                continue
+            try:
+                copy_metadata(src_file, dest_file, st)
+            except OSError:
+                continue  # Vanished since, or not ours to change; metadata is best effort
+    metadata_pending.clear()
+
+def copy_file(src_file, dest_file, st, buffers, index):
+    total_size = st.st_size
+    if total_size < SMALL_FILE_THRESHOLD:
+        return copy_small_file(src_file, dest_file)
+    set_status(index, os.path.basename(src_file), total_size)
+    if sys.platform == 'darwin':
+        if try_clonefile(src_file, dest_file):
+            set_progress(index, total_size)
+            return total_size
+        if total_size <= KERNEL_COPY_CHUNK:
+            # shutil.copyfile() uses fcopyfile() here, which copies without a user-space buffer.
+            # It can't be paused or cancelled midway, so only files no bigger than one kernel
+            # copy step on Linux go this way; larger ones take the chunked path below.
+            shutil.copyfile(src_file, dest_file)
+            return total_size
+    with io.FileIO(src_file, 'rb') as src, io.FileIO(dest_file, 'wb') as dst:
+        if try_reflink(src.fileno(), dst.fileno()):
+            copied_size = total_size
+            set_progress(index, copied_size)
+        else:
+            advise_sequential(src.fileno(), total_size)
+            preallocate(dst.fileno(), total_size)
+            try:
+                copied_size = None
+                if HAVE_COPY_FILE_RANGE:
+                    copied_size = kernel_copy(src, dst, index)
+                if copied_size is None and sendfile_usable:
+                    copied_size = sendfile_copy(src, dst, index)
+                if copied_size is None and total_size > MMAP_THRESHOLD:
+                    copied_size = mmap_copy(src, dst, index)
+                elif copied_size is None and total_size >= 2 * buffer_size:
+                    copied_size = pipelined_copy(src, dst, ensure_buffers(buffers), index)
+                elif copied_size is None:
+                    copied_size = stream_copy(src, dst, ensure_buffers(buffers)[0], index)
+            finally:
+                # Every path writes at the file position, so it is what actually made it out.
+                # Truncating there releases blocks reserved past a short, cancelled or failed copy.
+                if _fallocate is not None and dst.tell() < total_size:
+                    os.ftruncate(dst.fileno(), dst.tell())
+                advise_done(src.fileno())
+                advise_done(dst.fileno())
+
+    return copied_size
+
+def copy_worker(index):
+    pin_to_cpu(index)
+    # Page-aligned anonymous memory, reused for every file this worker copies; two so reads and
+    # writes can overlap. Filled in by ensure_buffers() the first time a copy needs them.
+    buffers = []
 
+    while not cancel_event.is_set():
         try:
-            total_size = os.path.getsize(src_file)
-            copied_size = 0
+            batch = file_queue.get(timeout=QUEUE_WAIT_TIMEOUT)
+        except queue.Empty:
+            continue
+        if batch is None:
+            break
+        pause_event.wait()
 
-            with open(src_file, 'rb') as src, open(dest_file, 'wb') as dst:
-                while not cancel_event.is_set():
-                    pause_event.wait()
-                    chunk = src.read(buffer_size)
-                    if not chunk:
-                        break
-                    dst.write(chunk)
-                    copied_size += len(chunk)
+        if len(batch) > 1:
+            set_status(index, f"{len(batch)} small files from {os.path.basename(os.path.dirname(batch[0][0]))}")
 
-                    with thread_status_lock:
-                        thread_status[thread_name] = f"{os.path.basename(src_file)} – {copied_size // (1024 * 1024)}MB/{total_size // (1024 * 1024)}MB"
+        for src_file, dest_file, st in batch:
+            if cancel_event.is_set():
+                break
+            pause_event.wait()
 
-            shutil.copystat(src_file, dest_file)
-            total_bytes_copied += copied_size
+            try:
+                worker_bytes[index] += copy_file(src_file, dest_file, st, buffers, index)
+            except Exception as e:
+                set_status(index, f"Error: {os.path.basename(src_file)}")
+                worker_failed[index].append(dest_file)
+            finally:
+                worker_files[index] += 1  # Own slot only, so no lock; the UI sums them each tick
 
-        except Exception as e:
-            with thread_status_lock:
-                thread_status[thread_name] = f"Error: {os.path.basename(src_file)}"
-        finally:
-            copied_files += 1
-            progress_queue.put(copied_files)
-            with thread_status_lock:
-                thread_status[thread_name] = "Idle"
-            file_queue.task_done()
+        set_status(index, "Idle")
 
 # -------- UI Update --------
 def format_time(seconds):
@@ -93,56 +573,98 @@ def format_time(seconds):
     hrs, mins = divmod(mins, 60)
     return f"{hrs:02}:{mins:02}:{secs:02}"
 
+def tally_progress():
+    global copied_files, total_bytes_copied
+    copied_files = sum(worker_files)
+    total_bytes_copied = sum(worker_bytes)
+
 def update_ui():
+    global _last_drawn_files, _last_drawn_bytes, _last_drawn_second, _last_status_text
     try:
-        while not progress_queue.empty():
-            current = progress_queue.get_nowait()
-            percent = (current / total_files) * 100 if total_files else 0
-            percent_label.config(
-                text=f"{current}/{total_files} files copied ({percent:.1f}%)"
-            )
-            progress_bar['value'] = percent
-
+        tally_progress()
         elapsed = time.time() - start_time if start_time else 0
-        elapsed_label.config(text=f"Elapsed Time: {format_time(elapsed)}")
-
-        if copied_files > 0 and start_time:
-            estimated_total = (elapsed / copied_files) * total_files
-            remaining = estimated_total - elapsed
-            remaining_label.config(text=f"Estimated Remaining: {format_time(remaining)}")
-            speed = total_bytes_copied / elapsed if elapsed else 0
-            speed_label.config(text=f"Speed: {speed / (1024 * 1024):.2f} MB/s")
-        else:
-            remaining_label.config(text="Estimated Remaining: --:--:--")
-            speed_label.config(text="Speed: -- MB/s")
 
-        with thread_status_lock:
-            status_lines = [f"{k}: {v}" for k, v in sorted(thread_status.items())]
-        status_label.config(text="\n".join(status_lines[:10]))
+        # While the walk runs the total moves too, so keep redrawing until it's final
+        if (copied_files - _last_drawn_files >= max(1, total_files // REDRAW_STEPS)
+                or total_bytes_copied - _last_drawn_bytes >= REDRAW_BYTES
+                or not scan_done.is_set()):
+            _last_drawn_files = copied_files
+            _last_drawn_bytes = total_bytes_copied
+            percent = (copied_files / total_files) * 100 if total_files else 0
+            percent_var.set(f"{copied_files}/{total_files} files copied ({percent:.1f}%)")
+            progress_var.set(percent)
+
+            if copied_files > 0 and start_time:
+                estimated_total = (elapsed / copied_files) * total_files
+                remaining = estimated_total - elapsed
+                remaining_var.set(f"Estimated Remaining: {format_time(remaining)}")
+                speed = total_bytes_copied / elapsed if elapsed else 0
+                speed_var.set(f"Speed: {speed / (1024 * 1024):.2f} MB/s")
+            else:
+                remaining_var.set("Estimated Remaining: --:--:--")
+                speed_var.set("Speed: -- MB/s")
+
+        if int(elapsed) != _last_drawn_second:
+            _last_drawn_second = int(elapsed)
+            elapsed_var.set(f"Elapsed Time: {format_time(elapsed)}")
+
+        # With more workers than rows, idle ones give up their line to busy ones
+        crowded = len(worker_label) > STATUS_ROWS
+        status_lines = []
+        idle = 0
+        for i, label in enumerate(worker_label):
+            total = worker_total[i]
+            if total >= 0:
+                label = f"{label} – {worker_copied[i] // (1024 * 1024)}MB/{total // (1024 * 1024)}MB"
+            elif crowded and label in ("Idle", "Waiting..."):
+                idle += 1
+                continue
+            status_lines.append(f"Worker-{i+1}: {label}")
+        hidden = max(0, len(status_lines) - STATUS_ROWS) + idle
+        status_lines = status_lines[:STATUS_ROWS]
+        if hidden > 0:
+            status_lines.append(f"...and {hidden} more workers, {idle} of them idle")
+        status_text = "\n".join(status_lines)
+        if status_text != _last_status_text:
+            _last_status_text = status_text
+            status_var.set(status_text)
 
     except Exception as e:
         print("UI update error:", e)
     finally:
-        if copied_files < total_files and not cancel_event.is_set():
+        if (not scan_done.is_set() or copied_files < total_files) and not cancel_event.is_set():
             root.after(200, update_ui)
 
 # -------- Finalize UI --------
 def finalize_ui():
-    percent_label.config(
-        text=f"{copied_files}/{total_files} files copied (100%)"
-    )
-    progress_bar['value'] = 100
+    if total_files == 0:
+        status_var.set("Status: Idle")
+        start_button.config(state=tk.NORMAL)
+        pause_button.config(state=tk.DISABLED)
+        resume_button.config(state=tk.DISABLED)
+        cancel_button.config(state=tk.DISABLED)
+        messagebox.showinfo("Info", "No files to copy.")
+        return
+    failed = sum(len(dests) for dests in worker_failed)
+    if failed:
+        percent_var.set(f"{copied_files - failed}/{total_files} files copied, {failed} failed")
+    else:
+        percent_var.set(f"{copied_files}/{total_files} files copied (100%)")
+    progress_var.set(100)
     elapsed = time.time() - start_time if start_time else 0
-    elapsed_label.config(text=f"Elapsed Time: {format_time(elapsed)}")
-    remaining_label.config(text="Estimated Remaining: 00:00:00")
-    speed_label.config(text="Speed: -- MB/s")
+    elapsed_var.set(f"Elapsed Time: {format_time(elapsed)}")
+    remaining_var.set("Estimated Remaining: 00:00:00")
+    speed_var.set("Speed: -- MB/s")
     root.title("File Copier – 100% Complete")
-    status_label.config(text="Copy completed!")
+    status_var.set(f"Copy completed with {failed} failed files." if failed else "Copy completed!")
     start_button.config(state=tk.NORMAL)
     pause_button.config(state=tk.DISABLED)
     resume_button.config(state=tk.DISABLED)
     cancel_button.config(state=tk.DISABLED)
-    messagebox.showinfo("Done", "All files copied successfully!")
+    if failed:
+        messagebox.showwarning("Done", f"{failed} of {total_files} files could not be copied.")
+    else:
+        messagebox.showinfo("Done", "All files copied successfully!")
 
 # -------- Button Actions --------
 def browse_source():
@@ -156,10 +678,15 @@ def browse_dest():
         dest_dir_var.set(directory)
 
 def start_copy():
-    global copied_files, start_time, total_bytes_copied, total_files
+    global copied_files, start_time, total_bytes_copied, worker_failed
+    global _last_drawn_files, _last_drawn_bytes, _last_drawn_second, _last_status_text
     copied_files = 0
     total_bytes_copied = 0
+    _last_drawn_files = _last_drawn_bytes = 0
+    _last_drawn_second = -1
+    _last_status_text = None
     start_time = time.time()
+    worker_failed = []  # A cloned tree has no workers; run_copy sizes this otherwise
 
     source_dir = source_dir_var.get()
     dest_dir = dest_dir_var.get()
@@ -176,43 +703,104 @@ def start_copy():
     cancel_event.clear()
     pause_event.set()
 
-    populate_file_queue(source_dir)
-    if total_files == 0:
-        messagebox.showinfo("Info", "No files to copy.")
-        start_button.config(state=tk.NORMAL)
-        pause_button.config(state=tk.DISABLED)
-        resume_button.config(state=tk.DISABLED)
-        cancel_button.config(state=tk.DISABLED)
+    if _clonefile is not None:
+        # Cloning a big tree, and counting it afterwards, takes a while; keep the window responsive
+        status_var.set("Starting...")
+        threading.Thread(target=clone_tree_job, args=(source_dir, dest_dir), daemon=True).start()
+        return
+    run_copy(source_dir, dest_dir)
+
+def clone_tree_job(source_dir, dest_dir):
+    global total_files, copied_files
+    try:
+        cloned = try_clone_tree(source_dir, dest_dir)
+    except OSError as e:
+        root.after(0, clone_failed, e)
+        return
+    if cancel_event.is_set():
+        root.after(0, cancel_finished)
+        return
+    if not cloned:
+        root.after(0, run_copy, source_dir, dest_dir)
         return
+    count = 0
+    for _, files in scan_files(source_dir, dest_dir):
+        if cancel_event.is_set():
+            break
+        count += len(files)
+    total_files = copied_files = count
+    root.after(0, cancel_finished if cancel_event.is_set() else finalize_ui)
+
+def clone_failed(error):
+    # The clone failed and the destination directory it replaces couldn't be recreated
+    messagebox.showerror("Error", f"Could not recreate the destination directory: {error}")
+    status_var.set("Status: Idle")
+    start_button.config(state=tk.NORMAL)
+    pause_button.config(state=tk.DISABLED)
+    resume_button.config(state=tk.DISABLED)
+    cancel_button.config(state=tk.DISABLED)
 
-    status_label.config(text=f"Starting... {total_files} files found")
+def run_copy(source_dir, dest_dir):
+    global worker_label, worker_copied, worker_total, worker_files, worker_bytes, worker_failed
+    global total_files, buffer_size, clone_usable, preserve_metadata, preserve_xattrs
+    total_files = 0
+    scan_done.clear()
+    with file_queue.mutex:
+        file_queue.queue.clear()  # Anything a cancelled walk queued after cancel_copy emptied it
+    status_var.set("Starting... scanning for files")
+    buffer_size = probe_buffer_size(dest_dir)
+    # Clones only work within one filesystem; across devices don't spend an ioctl per file finding out
+    clone_usable = os.stat(source_dir).st_dev == os.stat(dest_dir).st_dev
+    preserve_xattrs = preserve_xattrs_var.get()
+    # Contents only unless asked; extended attributes come with timestamps and permissions
+    preserve_metadata = preserve_metadata_var.get() or preserve_xattrs
+    metadata_pending.clear()
     num_threads = estimate_thread_count()
+    if is_rotational(source_dir):
+        # One reader taking files in walk order keeps the heads sweeping forward
+        num_threads = min(num_threads, ROTATIONAL_THREADS)
+    worker_label = ["Waiting..."] * num_threads
+    worker_copied = array.array('q', [0] * num_threads)
+    worker_total = array.array('q', [-1] * num_threads)
+    worker_files = array.array('q', [0] * num_threads)
+    worker_bytes = array.array('q', [0] * num_threads)
+    worker_failed = [[] for _ in range(num_threads)]
 
     threads = []
     for i in range(num_threads):
-        name = f"Worker-{i+1}"
-        with thread_status_lock:
-            thread_status[name] = "Waiting..."
-        t = threading.Thread(target=copy_worker, args=(source_dir, dest_dir), daemon=True, name=name)
+        t = threading.Thread(target=copy_worker, args=(i,), daemon=True, name=f"Worker-{i+1}")
         t.start()
         threads.append(t)
 
+    # Workers start on the first files while the walk is still going
+    walker = threading.Thread(target=populate_file_queue, args=(source_dir, dest_dir, num_threads), daemon=True)
+    walker.start()
+
     def wait_for_completion():
-        file_queue.join()
-        root.after(0, finalize_ui)
+        for t in threads:
+            t.join()
+        walker.join()
+        tally_progress()  # Final figures; the workers are gone, so nothing changes them any more
+        if preserve_metadata and not cancel_event.is_set():
+            root.after(0, status_var.set, "Applying timestamps and permissions...")
+            apply_metadata()
+        if cancel_event.is_set():
+            root.after(0, cancel_finished)
+        else:
+            root.after(0, finalize_ui)
 
     threading.Thread(target=wait_for_completion, daemon=True).start()
     root.after(100, update_ui)
 
 def pause_copy():
     pause_event.clear()
-    status_label.config(text="Paused...")
+    status_var.set("Paused...")
     pause_button.config(state=tk.DISABLED)
     resume_button.config(state=tk.NORMAL)
 
 def resume_copy():
     pause_event.set()
-    status_label.config(text="Resuming...")
+    status_var.set("Resuming...")
     pause_button.config(state=tk.NORMAL)
     resume_button.config(state=tk.DISABLED)
 
@@ -221,26 +809,41 @@ def cancel_copy():
     pause_event.set()
     with file_queue.mutex:
         file_queue.queue.clear()
-    status_label.config(text="Cancelling...")
-    progress_bar['value'] = 0
-    percent_label.config(text="0/0 files copied (0%)")
-    elapsed_label.config(text="Elapsed Time: 00:00:00")
-    remaining_label.config(text="Estimated Remaining: --:--:--")
-    speed_label.config(text="Speed: -- MB/s")
-    start_button.config(state=tk.NORMAL)
+    status_var.set("Cancelling...")
+    progress_var.set(0)
+    percent_var.set("0/0 files copied (0%)")
+    elapsed_var.set("Elapsed Time: 00:00:00")
+    remaining_var.set("Estimated Remaining: --:--:--")
+    speed_var.set("Speed: -- MB/s")
+    # Start stays off until cancel_finished: a worker busy in a long syscall only notices the
+    # cancel afterwards, and a new run must not share the queue and counters with it
     pause_button.config(state=tk.DISABLED)
     resume_button.config(state=tk.DISABLED)
     cancel_button.config(state=tk.DISABLED)
     root.title("File Copier – Cancelled")
 
+def cancel_finished():
+    # Every thread of the cancelled run has exited
+    status_var.set("Cancelled")
+    start_button.config(state=tk.NORMAL)
+
 # -------- GUI Setup --------
 root = tk.Tk()
 root.title("File Copier")
-root.geometry("600x500")
+root.geometry("600x580")
 root.resizable(False, False)
 
 source_dir_var = tk.StringVar()
 dest_dir_var = tk.StringVar()
+preserve_metadata_var = tk.BooleanVar(value=False)
+preserve_xattrs_var = tk.BooleanVar(value=False)
+# Progress widgets are bound to variables; setting one only redraws its widget at the next idle pass
+progress_var = tk.DoubleVar(value=0)
+percent_var = tk.StringVar(value="0/0 files copied (0%)")
+elapsed_var = tk.StringVar(value="Elapsed Time: 00:00:00")
+remaining_var = tk.StringVar(value="Estimated Remaining: --:--:--")
+speed_var = tk.StringVar(value="Speed: -- MB/s")
+status_var = tk.StringVar(value="Status: Idle")
 
 frame = ttk.Frame(root, padding=10)
 frame.pack(fill=tk.BOTH, expand=True)
@@ -257,22 +860,25 @@ ttk.Label(dest_frame, text="Destination Directory:").pack(side=tk.LEFT)
 ttk.Entry(dest_frame, textvariable=dest_dir_var, width=40).pack(side=tk.LEFT, padx=5)
 ttk.Button(dest_frame, text="Browse", command=browse_dest).pack(side=tk.LEFT)
 
-progress_bar = ttk.Progressbar(frame, length=500)
+ttk.Checkbutton(frame, text="Preserve timestamps and permissions", variable=preserve_metadata_var).pack(anchor="w", pady=(5, 0))
+ttk.Checkbutton(frame, text="Preserve extended attributes (slower)", variable=preserve_xattrs_var).pack(anchor="w", pady=5)
+
+progress_bar = ttk.Progressbar(frame, length=500, variable=progress_var)
 progress_bar.pack(pady=10)
 
-percent_label = ttk.Label(frame, text="0/0 files copied (0%)", font=("Segoe UI", 10))
+percent_label = ttk.Label(frame, textvariable=percent_var, font=("Segoe UI", 10))
 percent_label.pack()
 
-elapsed_label = ttk.Label(frame, text="Elapsed Time: 00:00:00", font=("Segoe UI", 10))
+elapsed_label = ttk.Label(frame, textvariable=elapsed_var, font=("Segoe UI", 10))
 elapsed_label.pack()
 
-remaining_label = ttk.Label(frame, text="Estimated Remaining: --:--:--", font=("Segoe UI", 10))
+remaining_label = ttk.Label(frame, textvariable=remaining_var, font=("Segoe UI", 10))
 remaining_label.pack()
 
-speed_label = ttk.Label(frame, text="Speed: -- MB/s", font=("Segoe UI", 10))
+speed_label = ttk.Label(frame, textvariable=speed_var, font=("Segoe UI", 10))
 speed_label.pack()
 
-status_label = ttk.Label(frame, text="Status: Idle", font=("Segoe UI", 10), anchor="w", justify="left")
+status_label = ttk.Label(frame, textvariable=status_var, font=("Segoe UI", 10), anchor="w", justify="left")
 status_label.pack(fill=tk.X, pady=5)
 
 button_frame = ttk.Frame(frame)